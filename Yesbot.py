@@ -5,14 +5,29 @@ Clean, professional, and easy to manage
 
 import os
 import json
+import gzip
+import html
+import time
+import uuid
+import heapq
+import random
+import asyncio
 import logging
-from dataclasses import dataclass, asdict
-from typing import Dict, List, Optional
-from datetime import datetime
+import functools
+import itertools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from logging.handlers import RotatingFileHandler
+from dataclasses import dataclass, asdict, field
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import Application, ApplicationHandlerStop, BaseRateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, TypeHandler, filters
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
@@ -24,17 +39,73 @@ BOT_TOKEN = "7895888177:AAEYLZ9zHxovachLhTIfr7-zs3IYUmxzvng"
 OWNER_ID = 5662429081  # Replace with owner's Telegram ID
 ADMIN_IDS = {6340039582,7487465564}  # Add more admin IDs here
 DATA_FILE = "shop_data.json"
+CATEGORIES_FILE = "categories.json"  # Edit and run /reloadcategories, no restart needed
+
+# Outbound scheduling (Telegram allows ~30 msg/s overall and ~1 msg/s per chat)
+OUTBOUND_CONCURRENCY = 8  # In-flight scheduled Bot API calls (sends, edits, deletes)
+SPARE_CONNECTIONS = 4  # Extra pool slots for unscheduled calls like answerCallbackQuery
+GLOBAL_RATE_LIMIT = 30  # Messages per second across all chats
+PER_CHAT_RATE_LIMIT = 1  # Messages per second in a single chat
+PER_CHAT_BURST = 3  # Short bursts allowed per chat (e.g. photo + text + delete)
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Send priorities (lower goes first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+
+# Delivery health
+DEAD_USER_FAILURE_THRESHOLD = 3  # Consecutive failed sends before a user is marked inactive
+DEAD_CHAT_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid")  # BadRequests that mean the chat is gone
+
+# Inventory
+RESERVATION_TTL = 15 * 60  # Seconds a checkout may hold stock before it is released
+RESERVATION_SWEEP_INTERVAL = 60  # Seconds between background expiry sweeps
+LOW_STOCK_THRESHOLD = 3
+LEGACY_STOCK_LEVEL = 100  # Stock given to products saved before stock counts existed
+
+# Order archive
+ARCHIVE_DIR = "order_archive"
+ARCHIVE_AFTER_DAYS = 30  # Finished orders older than this leave shop_data.json
+ARCHIVE_SEGMENT_SIZE = 500  # Orders per compressed segment file
+ARCHIVE_INTERVAL = 6 * 60 * 60  # Seconds between archival runs while the bot is up
+ORDER_ID_ATTEMPTS = 20  # Random tries per ID length before moving to a longer one
+FINAL_ORDER_STATUSES = ("delivered", "cancelled")
+
+# Idempotency
+IDEMPOTENCY_CACHE_SIZE = 2000  # Recent update IDs and checkout flows remembered across restarts
+
+# Tracing (off by default)
+TRACE_SAMPLE_RATE = 0.0  # Fraction of updates to trace, e.g. 0.05
+SLOW_UPDATE_MS = 2000  # Traced updates slower than this are captured
+SLOW_TRACE_BUFFER = 50  # Recent slow traces kept in memory for /slowtraces
+SLOW_TRACE_FILE = "slow_updates.log"
+REDACTED_UPDATE_FIELDS = {"text", "caption", "first_name", "last_name", "username", "phone_number"}
 
 # ============= DATA MODELS =============
+@dataclass
+class Category:
+    key: str
+    name: str
+    show_price: bool  # False means "contact seller for price" and no ordering
+    note: str = ""
+
 @dataclass
 class Product:
     id: str
     name: str
-    category: str  # "pc", "laptop", "shoes"
+    category: str  # Category key
     description: str
     price: int
     images: List[str]  # List of file_ids
-    in_stock: bool = True
+    stock: int = 0
+
+@dataclass
+class OrderItem:
+    product_id: str
+    product_name: str
+    quantity: int
+    unit_price: int
 
 @dataclass
 class Order:
@@ -43,34 +114,85 @@ class Order:
     username: Optional[str]
     full_name: str
     phone: str
-    product_id: str
-    product_name: str
-    quantity: int
+    items: List[OrderItem]
     total_price: int
     delivery_address: str
     status: str  # pending, confirmed, shipped, delivered, cancelled
     timestamp: str
 
+@dataclass
+class CustomerProfile:
+    user_id: int
+    phone: str
+    address: str
+
+@dataclass
+class DeliveryHealth:
+    user_id: int
+    last_success: Optional[str] = None
+    consecutive_failures: int = 0
+    active: bool = True
+
 # ============= GLOBAL STORAGE =============
+categories: Dict[str, Category] = {}  # In menu order
 products: Dict[str, Product] = {}
 orders: Dict[str, Order] = {}
 user_states: Dict[int, Dict] = {}
+carts: Dict[int, Dict[str, int]] = {}  # user_id -> {product_id: quantity}, lives with user_states
+customer_profiles: Dict[int, CustomerProfile] = {}
 user_ids_set: set = set()
+processed_updates: "OrderedDict[int, None]" = OrderedDict()  # Recently handled update_ids
+in_flight_updates: "OrderedDict[int, None]" = OrderedDict()  # Dispatched, handler not finished yet (not saved)
+completed_flows: "OrderedDict[str, str]" = OrderedDict()  # "user_id:flow_id" -> order_id
+delivery_health: Dict[int, DeliveryHealth] = {}
+delivery_stats: Dict[str, int] = {"skipped_sends": 0}
 # ============= DATA PERSISTENCE =============
 def save_data():
     """Save all data to JSON file"""
+    with trace_span("save_data"):
+        _save_data()
+
+def _save_data():
     try:
         data = {
             "products": {pid: asdict(p) for pid, p in products.items()},
             "orders": {oid: asdict(o) for oid, o in orders.items()},
             "admin_ids": list(ADMIN_IDS),
-            "user_ids": list(user_ids_set)  # Add this line
+            "user_ids": list(user_ids_set),  # Add this line
+            "customers": {uid: asdict(c) for uid, c in customer_profiles.items()},
+            "delivery_health": {uid: asdict(h) for uid, h in delivery_health.items()},
+            "delivery_stats": delivery_stats,
+            "processed_updates": persisted_update_ids(),
+            "completed_flows": completed_flows
         }
         with open(DATA_FILE, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
     except Exception as e:
         logger.error(f"Error saving data: {e}")
 
+def product_from_dict(pdata: Dict) -> Product:
+    """Build a Product, giving old in_stock-only records a stock level"""
+    pdata = dict(pdata)
+    in_stock = pdata.pop("in_stock", True)
+    if "stock" not in pdata:
+        pdata["stock"] = LEGACY_STOCK_LEVEL if in_stock else 0
+    return Product(**pdata)
+
+def order_from_dict(odata: Dict) -> Order:
+    """Build an Order, upgrading old single-product records to line items"""
+    odata = dict(odata)
+    if "items" in odata:
+        items = [OrderItem(**item) for item in odata.pop("items")]
+    else:
+        quantity = odata.pop("quantity")
+        items = [OrderItem(
+            product_id=odata.pop("product_id"),
+            product_name=odata.pop("product_name"),
+            quantity=quantity,
+            unit_price=odata["total_price"] // quantity
+        )]
+    return Order(items=items, **odata)
+
 def load_data():
     """Load data from JSON file"""
     global products, orders, ADMIN_IDS
@@ -85,11 +207,15 @@ def load_data():
         
         # Load products
         for pid, pdata in data.get("products", {}).items():
-            products[pid] = Product(**pdata)
+            products[pid] = product_from_dict(pdata)
         
         # Load orders
         for oid, odata in data.get("orders", {}).items():
-            orders[oid] = Order(**odata)
+            orders[oid] = order_from_dict(odata)
+        
+        # Load saved customer details
+        for uid, cdata in data.get("customers", {}).items():
+            customer_profiles[int(uid)] = CustomerProfile(**cdata)
         
         # Load admin IDs
         if "admin_ids" in data:
@@ -97,10 +223,647 @@ def load_data():
         # Load user IDs
         if "user_ids" in data:
             user_ids_set.update(data["user_ids"])
+        # Load delivery health
+        for uid, hdata in data.get("delivery_health", {}).items():
+            delivery_health[int(uid)] = DeliveryHealth(**hdata)
+        delivery_stats.update(data.get("delivery_stats", {}))
+        # Load idempotency caches
+        processed_updates.update(dict.fromkeys(data.get("processed_updates", [])))
+        completed_flows.update(data.get("completed_flows", {}))
+        inventory.rebuild()
         logger.info(f"Loaded {len(products)} products, {len(orders)} orders")
     except Exception as e:
         logger.error(f"Error loading data: {e}")
 
+DEFAULT_CATEGORIES = [
+    Category(
+        key="pc",
+        name="Gagdets and Accessories💻⚡️",
+        show_price=True,
+        note="Every gadget comes with a free case, charger, screenguard & earpiece/earpods/stylus pen depending on the gadget purchase❤️"
+    ),
+    Category(key="laptop", name="Your Customized Home🏡(Stickers, books etc.)🤭", show_price=False),
+    Category(key="shoes", name="Shoes & Jewelleries✨😎", show_price=False),
+]
+
+def load_categories() -> bool:
+    """Load categories from their file, creating it with the defaults on first run"""
+    if not os.path.exists(CATEGORIES_FILE):
+        try:
+            with open(CATEGORIES_FILE, "w", encoding="utf-8") as f:
+                json.dump([asdict(c) for c in DEFAULT_CATEGORIES], f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"Error writing default categories: {e}")
+            categories.update({c.key: c for c in DEFAULT_CATEGORIES})
+            return False
+    
+    try:
+        with open(CATEGORIES_FILE, "r", encoding="utf-8") as f:
+            loaded = [Category(**cdata) for cdata in json.load(f)]
+    except Exception as e:
+        # Keep whatever we had, a typo in the file shouldn't empty the shop
+        logger.error(f"Error loading categories: {e}")
+        if not categories:
+            categories.update({c.key: c for c in DEFAULT_CATEGORIES})
+        return False
+    
+    categories.clear()
+    categories.update({c.key: c for c in loaded})
+    logger.info(f"Loaded {len(categories)} categories")
+    return True
+
+# ============= ORDER ARCHIVE =============
+# Old finished orders move out of shop_data.json into gzip'd JSON-lines segments.
+# Segments are written once and never touched again; index.json maps
+# order_id -> [segment, line] and user_id -> [order_id, ...].
+archive_index: Dict[str, Dict] = {"orders": {}, "users": {}}
+
+def load_archive_index():
+    """Load the archive index"""
+    path = os.path.join(ARCHIVE_DIR, "index.json")
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            archive_index.update(json.load(f))
+        logger.info(f"Archive holds {len(archive_index['orders'])} orders")
+    except Exception as e:
+        logger.error(f"Error loading archive index: {e}")
+
+def save_archive_index():
+    """Write the archive index atomically"""
+    path = os.path.join(ARCHIVE_DIR, "index.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(archive_index, f)
+    os.replace(path + ".tmp", path)
+
+@lru_cache(maxsize=4)
+def read_segment(segment: str) -> tuple:
+    """Raw JSON lines of a segment (segments are immutable, so caching is safe)"""
+    with gzip.open(os.path.join(ARCHIVE_DIR, segment), "rt", encoding="utf-8") as f:
+        return tuple(f)
+
+def get_archived_order(order_id: str) -> Optional[Order]:
+    """Read one order back from cold storage"""
+    location = archive_index["orders"].get(order_id)
+    if not location:
+        return None
+    segment, line = location
+    try:
+        with trace_span("archive_read"):
+            return order_from_dict(json.loads(read_segment(segment)[line]))
+    except Exception as e:
+        logger.error(f"Error reading archived order {order_id}: {e}")
+        return None
+
+def get_order(order_id: str) -> Optional[Order]:
+    """Find an order in the hot set or the archive"""
+    return orders.get(order_id) or get_archived_order(order_id)
+
+def archived_order_ids(user_id: int) -> List[str]:
+    """Archived order IDs for a user, oldest first"""
+    return archive_index["users"].get(str(user_id), [])
+
+def archive_old_orders() -> int:
+    """Move finished orders older than ARCHIVE_AFTER_DAYS into new segments"""
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    to_archive = []
+    for order in orders.values():
+        if order.status not in FINAL_ORDER_STATUSES:
+            continue
+        try:
+            placed = datetime.strptime(order.timestamp, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+        if placed < cutoff:
+            to_archive.append(order)
+    
+    if not to_archive:
+        return 0
+    
+    to_archive.sort(key=lambda o: o.timestamp)
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        
+        # Orders already indexed were archived by a run that died before save_data
+        fresh = [o for o in to_archive if o.order_id not in archive_index["orders"]]
+        for start in range(0, len(fresh), ARCHIVE_SEGMENT_SIZE):
+            chunk = fresh[start:start + ARCHIVE_SEGMENT_SIZE]
+            segment = f"segment-{datetime.now():%Y%m%d%H%M%S}-{start // ARCHIVE_SEGMENT_SIZE:03d}.jsonl.gz"
+            with gzip.open(os.path.join(ARCHIVE_DIR, segment), "xt", encoding="utf-8") as f:
+                for order in chunk:
+                    f.write(json.dumps(asdict(order), ensure_ascii=False) + "\n")
+            for line, order in enumerate(chunk):
+                archive_index["orders"][order.order_id] = [segment, line]
+                archive_index["users"].setdefault(str(order.user_id), []).append(order.order_id)
+        save_archive_index()
+    except Exception as e:
+        logger.error(f"Error archiving orders: {e}")
+        return 0
+    
+    for order in to_archive:
+        orders.pop(order.order_id, None)
+    save_data()
+    
+    logger.info(f"Archived {len(to_archive)} orders")
+    return len(to_archive)
+
+# ============= IDEMPOTENCY =============
+def remember(cache: OrderedDict, key, value=None):
+    """Add to a bounded recently-seen cache, evicting the oldest entries"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > IDEMPOTENCY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Skip updates Telegram delivers twice (e.g. redelivery after a crash)"""
+    if update.update_id in processed_updates or update.update_id in in_flight_updates:
+        logger.info(f"Skipping duplicate update {update.update_id}")
+        raise ApplicationHandlerStop
+    remember(in_flight_updates, update.update_id)
+
+# The update the current handler task is working on
+handling_update_id: ContextVar[Optional[int]] = ContextVar("handling_update_id", default=None)
+
+def persisted_update_ids() -> List[int]:
+    """
+    Update IDs to write in a snapshot.
+
+    Finished updates, plus the one whose handler is calling save_data right now:
+    its side effects are in this same snapshot, so a redelivery must be dropped.
+    Other in-flight updates (e.g. a broadcast still sending) are left out.
+    """
+    update_ids = list(processed_updates)
+    current = handling_update_id.get()
+    if current is not None and current not in processed_updates:
+        update_ids.append(current)
+    return update_ids
+
+def finishes_update(callback):
+    """
+    Wrap a handler so its update_id only counts as processed once it returns.
+
+    Before that, the ID is only saved by the handler's own save_data, so a crash
+    mid-handler (e.g. half way through a non-blocking broadcast) lets Telegram's
+    redelivery through.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if not isinstance(update, Update):
+            return await callback(update, context)
+        
+        token = handling_update_id.set(update.update_id)
+        try:
+            return await callback(update, context)
+        finally:
+            handling_update_id.reset(token)
+            if update.update_id in in_flight_updates:
+                del in_flight_updates[update.update_id]
+                remember(processed_updates, update.update_id)
+    return wrapper
+
+def completed_order(user_id: int, flow_id: Optional[str]) -> Optional[Order]:
+    """The order already placed by this checkout flow, if any"""
+    order_id = completed_flows.get(f"{user_id}:{flow_id}")
+    return get_order(order_id) if order_id else None
+
+# ============= INVENTORY =============
+@dataclass
+class Reservation:
+    user_id: int
+    items: Dict[str, int]  # product_id -> quantity
+    expires_at: float
+
+class Inventory:
+    """
+    Stock held for in-flight checkouts, one reservation per user.
+
+    No method awaits, so each call runs atomically on the event loop no matter
+    how many checkouts are in flight. Unclaimed reservations expire whenever
+    stock is read and on a timer (see post_init), so the indexes never go stale.
+    """
+
+    def __init__(self):
+        self.reserved: Dict[str, int] = {}  # product_id -> quantity held
+        self.reservations: Dict[int, Reservation] = {}
+        self._expiry: List = []  # heap of (expires_at, user_id)
+        self.low_stock: set = set()  # available <= LOW_STOCK_THRESHOLD
+        self.sold_out: set = set()  # available <= 0
+        self.in_stock_by_category: Dict[str, set] = {}  # category -> product_ids with stock available
+        self._indexed_category: Dict[str, str] = {}  # product_id -> category it is indexed under
+
+    def available(self, product_id: str) -> int:
+        self.expire()
+        return self._available(product_id)
+
+    def available_for(self, user_id: int, product_id: str) -> int:
+        """Stock this user can still take, counting their own held units as theirs"""
+        available = self.available(product_id)
+        reservation = self.reservations.get(user_id)
+        if reservation:
+            available += reservation.items.get(product_id, 0)
+        return available
+
+    def _available(self, product_id: str) -> int:
+        product = products.get(product_id)
+        if not product:
+            return 0
+        return product.stock - self.reserved.get(product_id, 0)
+
+    def reindex(self, product_id: str):
+        """Refresh the low-stock index for one product"""
+        available = self._available(product_id)
+        if available <= LOW_STOCK_THRESHOLD and product_id in products:
+            self.low_stock.add(product_id)
+        else:
+            self.low_stock.discard(product_id)
+        if available <= 0 and product_id in products:
+            self.sold_out.add(product_id)
+        else:
+            self.sold_out.discard(product_id)
+        
+        indexed = self._indexed_category.pop(product_id, None)
+        if indexed is not None:
+            self.in_stock_by_category[indexed].discard(product_id)
+        if available > 0 and product_id in products:
+            category = products[product_id].category
+            self._indexed_category[product_id] = category
+            self.in_stock_by_category.setdefault(category, set()).add(product_id)
+
+    def rebuild(self):
+        self.low_stock.clear()
+        self.sold_out.clear()
+        self.in_stock_by_category.clear()
+        self._indexed_category.clear()
+        for product_id in products:
+            self.reindex(product_id)
+
+    def in_stock(self, category: str) -> List[str]:
+        """Product ids with stock available in a category, in catalogue order"""
+        self.expire()
+        return sorted(self.in_stock_by_category.get(category, ()))
+
+    def category_count(self, category: str) -> int:
+        self.expire()
+        return len(self.in_stock_by_category.get(category, ()))
+
+    def expire(self):
+        """Drop reservations whose checkout was abandoned"""
+        now = time.monotonic()
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._expiry)
+            reservation = self.reservations.get(user_id)
+            if reservation and reservation.expires_at == expires_at:
+                self.release(user_id)
+
+    def holds(self, user_id: int, items: Dict[str, int]) -> bool:
+        """Whether the user's live reservation covers exactly these items"""
+        self.expire()
+        reservation = self.reservations.get(user_id)
+        return reservation is not None and reservation.items == items
+
+    def reserve(self, user_id: int, items: Dict[str, int]) -> List[str]:
+        """Hold stock for every item or none; returns the product ids that are short"""
+        self.expire()
+        self.release(user_id)
+        short = [pid for pid, qty in items.items() if self._available(pid) < qty]
+        if short:
+            return short
+        
+        expires_at = time.monotonic() + RESERVATION_TTL
+        self.reservations[user_id] = Reservation(user_id=user_id, items=dict(items), expires_at=expires_at)
+        heapq.heappush(self._expiry, (expires_at, user_id))
+        for pid, qty in items.items():
+            self.reserved[pid] = self.reserved.get(pid, 0) + qty
+            self.reindex(pid)
+        return []
+
+    def release(self, user_id: int):
+        """Give a user's held stock back"""
+        reservation = self.reservations.pop(user_id, None)
+        if not reservation:
+            return
+        for pid, qty in reservation.items.items():
+            self.reserved[pid] -= qty
+            if not self.reserved[pid]:
+                del self.reserved[pid]
+            self.reindex(pid)
+
+    def commit(self, user_id: int) -> bool:
+        """Turn a user's reservation into a sale (stock never drops below what is reserved)"""
+        self.expire()
+        reservation = self.reservations.pop(user_id, None)
+        if not reservation:
+            return False
+        for pid, qty in reservation.items.items():
+            self.reserved[pid] -= qty
+            if not self.reserved[pid]:
+                del self.reserved[pid]
+            if pid in products:
+                products[pid].stock -= qty
+            self.reindex(pid)
+        return True
+
+inventory = Inventory()
+
+def ensure_reservation(user_id: int) -> List[str]:
+    """Make sure the user's cart is held, re-reserving if it expired or changed"""
+    cart = carts.get(user_id, {})
+    if inventory.holds(user_id, cart):
+        return []
+    return inventory.reserve(user_id, cart)
+
+def trim_cart_to_stock(user_id: int, short: List[str]) -> str:
+    """Cut short items down to what is left and describe the change"""
+    cart = carts.get(user_id, {})
+    text = "😔 <b>Some items just sold out:</b>\n"
+    for pid in short:
+        available = max(0, inventory.available(pid))
+        name = products[pid].name if pid in products else pid
+        text += f"• {name}: {available} left\n"
+        if available:
+            cart[pid] = available
+        else:
+            cart.pop(pid, None)
+    return text + "\nYour cart has been updated."
+
+# ============= DELIVERY HEALTH =============
+def record_delivery_success(user_id: int):
+    """Mark a successful send to a user"""
+    health = delivery_health.setdefault(user_id, DeliveryHealth(user_id=user_id))
+    health.last_success = get_timestamp()
+    health.consecutive_failures = 0
+    health.active = True
+
+def record_delivery_failure(user_id: int, error: Exception):
+    """Count a failed send; deactivate the user once they look unreachable"""
+    if isinstance(error, BadRequest) and not any(e in error.message.lower() for e in DEAD_CHAT_ERRORS):
+        return  # Our mistake (bad markup etc.), not the user's chat
+    health = delivery_health.setdefault(user_id, DeliveryHealth(user_id=user_id))
+    health.consecutive_failures += 1
+    if health.active and health.consecutive_failures >= DEAD_USER_FAILURE_THRESHOLD:
+        health.active = False
+        logger.info(f"User {user_id} marked inactive after {health.consecutive_failures} failed sends")
+
+def mark_user_active(user_id: int):
+    """User reached out to us, so they can be messaged again"""
+    health = delivery_health.get(user_id)
+    if health and not health.active:
+        health.active = True
+        health.consecutive_failures = 0
+
+def is_user_active(user_id: int) -> bool:
+    health = delivery_health.get(user_id)
+    return health is None or health.active
+
+def active_user_ids() -> List[int]:
+    """Tracked users that bulk sends should still target"""
+    return [uid for uid in user_ids_set if is_user_active(uid)]
+
+# ============= TRACING =============
+# Opt-in per-update tracing. A sampled handler gets a root Span in a ContextVar;
+# trace_span() hangs child spans under it (Bot API calls, persistence) and is a
+# no-op for unsampled updates.
+@dataclass
+class Span:
+    name: str
+    start: float
+    end: Optional[float] = None
+    children: List["Span"] = field(default_factory=list)
+
+    def to_dict(self, origin: float) -> Dict:
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 1),
+            "duration_ms": round(((self.end or self.start) - self.start) * 1000, 1),
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+slow_traces: deque = deque(maxlen=SLOW_TRACE_BUFFER)
+slow_trace_logger = logging.getLogger("shop_bot.slow")
+slow_trace_logger.propagate = False
+
+@contextmanager
+def trace_span(name: str):
+    """Time a block as a child of the current span, if this update is traced"""
+    parent = current_span.get()
+    if parent is None:
+        yield
+        return
+    span = Span(name=name, start=time.perf_counter())
+    parent.children.append(span)
+    token = current_span.set(span)
+    try:
+        yield
+    finally:
+        span.end = time.perf_counter()
+        current_span.reset(token)
+
+def redact(value):
+    """Blank out personal fields in an update dict"""
+    if isinstance(value, dict):
+        return {
+            k: f"<redacted {len(v)} chars>" if k in REDACTED_UPDATE_FIELDS and isinstance(v, str) else redact(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+def capture_slow_trace(root: Span, update: object):
+    """Keep a slow update's trace in the ring buffer and the trace file"""
+    record = {
+        "time": get_timestamp(),
+        "handler": root.name,
+        "duration_ms": round((root.end - root.start) * 1000, 1),
+        "trace": root.to_dict(root.start),
+        "update": redact(update.to_dict()) if isinstance(update, Update) else None,
+    }
+    # Telegram stamps messages to the second; a large age means we were slow to dispatch
+    message = update.effective_message if isinstance(update, Update) else None
+    if message and message.date:
+        record["age_at_entry_s"] = round(time.time() - message.date.timestamp() - record["duration_ms"] / 1000, 1)
+    slow_traces.append(record)
+    slow_trace_logger.info(json.dumps(record, ensure_ascii=False))
+
+def traced(callback):
+    """Wrap a handler so a sample of updates is traced"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+            return await callback(update, context)
+        
+        root = Span(name=callback.__name__, start=time.perf_counter())
+        token = current_span.set(root)
+        try:
+            return await callback(update, context)
+        finally:
+            root.end = time.perf_counter()
+            current_span.reset(token)
+            if (root.end - root.start) * 1000 >= SLOW_UPDATE_MS:
+                capture_slow_trace(root, update)
+    return wrapper
+
+def wrap_handler(callback):
+    """Everything a registered handler goes through: tracing and update bookkeeping"""
+    return traced(finishes_update(callback))
+
+# ============= OUTBOUND SCHEDULER =============
+class TokenBucket:
+    """Simple token bucket measured on the event loop clock"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated: Optional[float] = None
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> float:
+        """Take a token (possibly borrowing) and return how long to wait for it"""
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundScheduler(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Single gate for every Bot API send, edit and delete.
+
+    Requests first wait on their chat's bucket, then queue by priority for
+    a slot in the global bucket. RetryAfter pauses everything and retries.
+    Pass rate_limit_args={"priority": PRIORITY_BULK} to lower a call's priority.
+    """
+
+    SCHEDULED_PREFIXES = ("send", "edit", "delete", "copy", "forward")
+    MAX_CHAT_BUCKETS = 10000  # Idle per-chat buckets beyond this are dropped
+
+    def __init__(self):
+        self._global = TokenBucket(GLOBAL_RATE_LIMIT, GLOBAL_RATE_LIMIT)
+        self._chats: "OrderedDict[Any, TokenBucket]" = OrderedDict()  # Least recently used first
+        self._waiters: List = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(OUTBOUND_CONCURRENCY)
+        self._paused_until = 0.0
+        self._pump_task: Optional[asyncio.Task] = None
+
+    async def initialize(self):
+        self._pump_task = asyncio.create_task(self._pump())
+
+    async def shutdown(self):
+        if self._pump_task:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        
+        # Evict from the least recently used end, stopping at the first busy
+        # bucket, so each insert costs amortized O(1) even mid-broadcast
+        while len(self._chats) >= self.MAX_CHAT_BUCKETS:
+            oldest = next(iter(self._chats.values()))
+            if not oldest.is_idle(now):
+                break
+            self._chats.popitem(last=False)
+        bucket = self._chats[chat_id] = TokenBucket(PER_CHAT_RATE_LIMIT, PER_CHAT_BURST)
+        return bucket
+
+    async def _pump(self):
+        """Hand out global slots to the highest-priority waiter"""
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self._slots.acquire()
+            while True:
+                now = loop.time()
+                delay = max(self._paused_until - now, self._global.wait_time(now))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self._global.consume(loop.time())
+            # Pop only now, so anything more urgent that arrived while we slept wins
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+            else:
+                self._slots.release()
+
+    async def _acquire(self, priority: int, chat_id):
+        loop = asyncio.get_running_loop()
+        if chat_id is not None:
+            await asyncio.sleep(self._chat_bucket(chat_id, loop.time()).consume(loop.time()))
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._slots.release()
+            raise
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(self.SCHEDULED_PREFIXES):
+            with trace_span(f"api.{endpoint}"):
+                return await callback(*args, **kwargs)
+
+        rate_limit_args = rate_limit_args or {}
+        priority = rate_limit_args.get("priority", PRIORITY_INTERACTIVE)
+        chat_id = data.get("chat_id")
+        track_delivery = endpoint.startswith("send") and chat_id in user_ids_set
+
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+            with trace_span("outbound_queue"):
+                await self._acquire(priority, chat_id)
+            try:
+                with trace_span(f"api.{endpoint}"):
+                    result = await callback(*args, **kwargs)
+                if track_delivery:
+                    record_delivery_success(chat_id)
+                return result
+            except (Forbidden, BadRequest) as e:
+                if track_delivery:
+                    record_delivery_failure(chat_id, e)
+                raise
+            except RetryAfter as e:
+                if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                loop = asyncio.get_running_loop()
+                self._paused_until = max(self._paused_until, loop.time() + retry_after)
+                logger.warning(f"Flood control on {endpoint}, pausing sends for {retry_after}s")
+            finally:
+                self._slots.release()
+
 # ============= HELPER FUNCTIONS =============
 def is_admin(user_id: int) -> bool:
     """Check if user is an admin"""
@@ -108,8 +871,21 @@ def is_admin(user_id: int) -> bool:
 
 def generate_order_id() -> str:
     """Generate unique order ID"""
-    import random
-    return f"ORD{random.randint(10000, 99999)}"
+    # Archived IDs stay taken forever, so widen the range once short IDs keep colliding
+    for digits in range(5, 13):
+        for _ in range(ORDER_ID_ATTEMPTS):
+            order_id = f"ORD{random.randint(10 ** (digits - 1), 10 ** digits - 1)}"
+            if order_id not in orders and order_id not in archive_index["orders"]:
+                return order_id
+    return f"ORD{uuid.uuid4().hex.upper()}"
+
+STATUS_EMOJI = {
+    "pending": "⏳",
+    "confirmed": "✅",
+    "shipped": "🚚",
+    "delivered": "📦",
+    "cancelled": "❌"
+}
 
 def format_price(amount: int) -> str:
     """Format price in Naira"""
@@ -121,16 +897,33 @@ def get_timestamp() -> str:
 
 async def notify_admins(context: ContextTypes.DEFAULT_TYPE, message: str):
     """Send notification to all admins"""
-    for admin_id in ADMIN_IDS:
+    async def notify(admin_id: int):
         try:
             await context.bot.send_message(
                 chat_id=admin_id,
                 text=message,
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                rate_limit_args={"priority": PRIORITY_ADMIN}
             )
         except Exception as e:
             logger.error(f"Failed to notify admin {admin_id}: {e}")
 
+    await asyncio.gather(*(notify(admin_id) for admin_id in ADMIN_IDS))
+
+def category_list_text() -> str:
+    """Category names for HTML messages (names come from an editable file)"""
+    return "".join(f"{html.escape(category.name)}\n" for category in categories.values())
+
+def category_buttons() -> List[List[InlineKeyboardButton]]:
+    """One browse button per category with its in-stock count"""
+    return [
+        [InlineKeyboardButton(
+            f"{category.name} ({inventory.category_count(key)})",
+            callback_data=f"browse_{key}"
+        )]
+        for key, category in categories.items()
+    ]
+
 # ============= USER COMMANDS =============
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Welcome message"""
@@ -138,22 +931,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Track user
     user_ids_set.add(user.id)
+    mark_user_active(user.id)
     save_data()
 
     welcome_text = (
-        f"🎉 Welcome {user.first_name}!\n\n"
+        f"🎉 Welcome {html.escape(user.first_name)}!\n\n"
         f"🛒 Your One-Stop Shop\n\n"
         f"Browse our collection:\n"
-        f"Gagdets and Accessories💻⚡️\n"
-        f"Your Customized Home🏡(Stickers, books etc.)🤭\n"
-        f"Shoes & Jewelleries✨😎\n\n"
+        f"{category_list_text()}\n"
         f"Use the menu below to get started! 🚀"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("Gagdets and Accessories💻⚡️", callback_data="browse_pc")],
-        [InlineKeyboardButton("Your Customized Home🏡(Stickers, books etc.)🤭", callback_data="browse_laptop")],
-        [InlineKeyboardButton("Shoes & Jewelleries✨😎", callback_data="browse_shoes")],
+    keyboard = category_buttons() + [
+        [InlineKeyboardButton("🛒 My Cart", callback_data="view_cart")],
         [InlineKeyboardButton("📦 My Orders", callback_data="my_orders")],
     ]
     
@@ -162,7 +952,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(
         welcome_text,
-        parse_mode=ParseMode.MARKDOWN,
+        parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
@@ -171,19 +961,15 @@ async def show_main_menu(query):
     user = query.from_user
     
     welcome_text = (
-        f"🎉 Welcome back {user.first_name}!\n\n"
+        f"🎉 Welcome back {html.escape(user.first_name)}!\n\n"
         f"🛒 <b>Your One-Stop Shop</b>\n\n"
         f"Browse our collection:\n"
-        f"Gagdets and Accessories💻⚡️\n"
-        f"Your Customized Home🏡(Stickers, books etc.)🤭\n"
-        f"Shoes & Jewelleries✨😎\n\n"
+        f"{category_list_text()}\n"
         f"Use the menu below to get started! 🚀"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("Gagdets and Accessories💻⚡️", callback_data="browse_pc")],
-        [InlineKeyboardButton("Your Customized Home🏡(Stickers, books etc.)🤭", callback_data="browse_laptop")],
-        [InlineKeyboardButton("Shoes & Jewelleries✨😎", callback_data="browse_shoes")],
+    keyboard = category_buttons() + [
+        [InlineKeyboardButton("🛒 My Cart", callback_data="view_cart")],
         [InlineKeyboardButton("📦 My Orders", callback_data="my_orders")],
     ]
     
@@ -192,7 +978,7 @@ async def show_main_menu(query):
     
     await query.edit_message_text(
         welcome_text,
-        parse_mode=ParseMode.MARKDOWN,
+        parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
@@ -213,6 +999,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/addproduct - Add new product\n"
             "/orders_admin - View all orders\n"
             "/broadcast &lt;message&gt; - Send to all users\n"
+            "/setstock &lt;product_id&gt; &lt;qty&gt; - Update stock\n"
+            "/slowtraces - Recent slow updates\n"
+            "/reloadcategories - Reload categories.json\n"
         )
     
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
@@ -222,6 +1011,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id in user_states:
         user_states.pop(user_id, None)
+        inventory.release(user_id)
         await update.message.reply_text("❌ Operation cancelled.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]]))
     else:
         await update.message.reply_text("No active operation to cancel.")
@@ -229,11 +1019,12 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============= PRODUCT BROWSING =============
 async def browse_category(query, category: str):
     """Show products in a category"""
-    category_products = [p for p in products.values() if p.category == category and p.in_stock]
+    category_info = categories.get(category)
+    category_products = [products[pid] for pid in inventory.in_stock(category)]
     
-    if not category_products:
+    if not category_info or not category_products:
         await query.edit_message_text(
-            f"😔 No {category}s available right now.\n\nCheck back soon!",
+            f"😔 Nothing in {category_info.name if category_info else 'this category'} right now.\n\nCheck back soon!",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
             ]])
@@ -241,15 +1032,14 @@ async def browse_category(query, category: str):
         return
     
     # Show product list
-    category_names = {"pc": "Gagdets and Accessories💻⚡️", "laptop": "Your Customized Home🏡(Stickers, books etc.)🤭", "shoes": "Shoes & Jewelleries✨😎"}
-    text = f"🛍️ <b>{category_names[category]}</b>\n\n"
+    text = f"🛍️ <b>{html.escape(category_info.name)}</b>\n\n"
     
-    if category == "pc":
-        text += "📝 <b>Note:</b> Every gadget comes with a free case, charger, screenguard & earpiece/earpods/stylus pen depending on the gadget purchase❤️\n\n"
+    if category_info.note:
+        text += f"📝 <b>Note:</b> {html.escape(category_info.note)}\n\n"
     
     keyboard = []
     for product in category_products:
-        if category == "pc":
+        if category_info.show_price:
             text += f"• {product.name} - {format_price(product.price)}\n"
         else:
             text += f"• {product.name}\n"
@@ -266,6 +1056,14 @@ async def browse_category(query, category: str):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+def stock_status(product: Product) -> str:
+    inventory.expire()
+    if product.id in inventory.sold_out:
+        return "❌ Out of Stock"
+    if product.id in inventory.low_stock:
+        return f"⚠️ Only {inventory.available(product.id)} left"
+    return "✅ In Stock"
+
 async def view_product(query, product_id: str):
     """Show detailed product view with images"""
     if product_id not in products:
@@ -275,15 +1073,17 @@ async def view_product(query, product_id: str):
     product = products[product_id]
     
     # Prepare caption based on category
-    if product.category == "pc":
+    category = categories.get(product.category)
+    if category and category.show_price:
         caption = (
             f"✨ <b>{product.name}</b>\n\n"
             f"📝 {product.description}\n\n"
             f"💰 <b>Price:</b> {format_price(product.price)}\n"
-            f"📦 <b>Status:</b> {'✅ In Stock' if product.in_stock else '❌ Out of Stock'}"
+            f"📦 <b>Status:</b> {stock_status(product)}"
         )
         keyboard = [
-            [InlineKeyboardButton("🛒 Order Now", callback_data=f"order_{product_id}")],
+            [InlineKeyboardButton("➕ Add to Cart", callback_data=f"order_{product_id}")],
+            [InlineKeyboardButton("🛒 View Cart", callback_data="view_cart")],
             [InlineKeyboardButton("◀️ Back", callback_data=f"browse_{product.category}")],
             [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
         ]
@@ -294,7 +1094,7 @@ async def view_product(query, product_id: str):
             f"📞 <b>Contact seller for price and availability</b>\n"
             f"📱 Phone: +2349040164120\n"
             f"📢 Telegram: @Tobi_Edmund\n\n"
-            f"📦 <b>Status:</b> {'✅ In Stock' if product.in_stock else '❌ Out of Stock'}"
+            f"📦 <b>Status:</b> {stock_status(product)}"
         )
         keyboard = [
             [InlineKeyboardButton("◀️ Back", callback_data=f"browse_{product.category}")],
@@ -339,7 +1139,7 @@ async def view_product(query, product_id: str):
 
 # ============= ORDER FLOW =============
 async def start_order(query, product_id: str):
-    """Start the ordering process"""
+    """Ask how many of a product to add to the cart"""
     if product_id not in products:
         await query.answer("Product not found!", show_alert=True)
         return
@@ -355,15 +1155,213 @@ async def start_order(query, product_id: str):
     }
     
     await query.edit_message_text(
-        f"🛒 <b>Order: {product.name}</b>\n\n"
+        f"🛒 <b>Add to Cart: {product.name}</b>\n\n"
         f"💰 Price: {format_price(product.price)}\n\n"
         f"📦 How many do you want?\n"
         f"(Type a number, e.g., 1, 2, 3)",
         parse_mode=ParseMode.HTML
     )
 
+def cart_total(cart: Dict[str, int]) -> int:
+    """Total price of a cart at current prices"""
+    return sum(products[pid].price * qty for pid, qty in cart.items() if pid in products)
+
+def cart_text(cart: Dict[str, int]) -> str:
+    """Render cart contents"""
+    text = "🛒 <b>Your Cart</b>\n\n"
+    for pid, qty in cart.items():
+        if pid in products:
+            product = products[pid]
+            text += f"• {product.name} x{qty} - {format_price(product.price * qty)}\n"
+    text += f"\n💰 <b>Total:</b> {format_price(cart_total(cart))}"
+    return text
+
+def cart_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Checkout", callback_data="checkout")],
+        [InlineKeyboardButton("🛍️ Continue Shopping", callback_data="main_menu")],
+        [InlineKeyboardButton("🗑️ Clear Cart", callback_data="clear_cart")],
+    ])
+
+def format_order_items(order: Order) -> str:
+    """One line per item in an order"""
+    return "".join(
+        f"• {item.product_name} x{item.quantity} - {format_price(item.unit_price * item.quantity)}\n"
+        for item in order.items
+    )
+
+async def show_cart(query):
+    """Show the user's cart"""
+    cart = carts.get(query.from_user.id)
+    
+    if not cart:
+        await query.edit_message_text(
+            "🛒 Your cart is empty.\n\nStart shopping!",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🛍️ Browse Products", callback_data="main_menu")
+            ]])
+        )
+        return
+    
+    await query.edit_message_text(
+        cart_text(cart),
+        parse_mode=ParseMode.HTML,
+        reply_markup=cart_keyboard()
+    )
+
+async def clear_cart(query):
+    """Empty the user's cart"""
+    user_id = query.from_user.id
+    carts.pop(user_id, None)
+    inventory.release(user_id)
+    if user_states.get(user_id, {}).get("action") == "checkout":
+        user_states.pop(user_id, None)
+    await show_cart(query)
+
+async def start_checkout(query):
+    """Start checkout, offering saved details to returning customers"""
+    user_id = query.from_user.id
+    cart = carts.get(user_id)
+    
+    if not cart:
+        await query.answer("Your cart is empty!", show_alert=True)
+        return
+    
+    # Hold the stock while the customer fills in their details
+    short = inventory.reserve(user_id, cart)
+    if short:
+        await query.edit_message_text(
+            f"{trim_cart_to_stock(user_id, short)}\n\n{cart_text(cart)}",
+            parse_mode=ParseMode.HTML,
+            reply_markup=cart_keyboard()
+        )
+        return
+    
+    flow_id = uuid.uuid4().hex[:12]
+    user_states[user_id] = {"action": "checkout", "step": "phone", "flow_id": flow_id}
+    profile = customer_profiles.get(user_id)
+    
+    if profile:
+        await query.edit_message_text(
+            f"{cart_text(cart)}\n\n"
+            f"📱 Phone: {html.escape(profile.phone)}\n"
+            f"🏠 Delivery Address: {html.escape(profile.address)}\n\n"
+            f"Deliver to your saved details?",
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Use Saved Details", callback_data=f"checkout_saved_{flow_id}")],
+                [InlineKeyboardButton("✏️ Enter New Details", callback_data="checkout_new")],
+                [InlineKeyboardButton("◀️ Back to Cart", callback_data="view_cart")],
+            ])
+        )
+        return
+    
+    await query.edit_message_text(
+        f"{cart_text(cart)}\n\n"
+        f"📱 Please enter your phone number:",
+        parse_mode=ParseMode.HTML
+    )
+
+async def checkout_new_details(query):
+    """Ask for fresh phone and address"""
+    user_id = query.from_user.id
+    if user_states.get(user_id, {}).get("action") != "checkout":
+        await query.answer("Checkout expired, open your cart again.", show_alert=True)
+        return
+    
+    user_states[user_id]["step"] = "phone"
+    await query.edit_message_text("📱 Please enter your phone number:")
+
+async def checkout_saved_details(query, context: ContextTypes.DEFAULT_TYPE, flow_id: str):
+    """Place the order with the saved phone and address"""
+    user = query.from_user
+    
+    # Double tap: the first tap already placed the order
+    if completed_order(user.id, flow_id):
+        return
+    
+    state = user_states.get(user.id, {})
+    profile = customer_profiles.get(user.id)
+    if state.get("action") != "checkout" or state.get("flow_id") != flow_id or not profile:
+        await query.answer("Checkout expired, open your cart again.", show_alert=True)
+        return
+    
+    short = ensure_reservation(user.id)
+    if short:
+        user_states.pop(user.id, None)
+        await query.edit_message_text(
+            f"{trim_cart_to_stock(user.id, short)}\n\n{cart_text(carts[user.id])}",
+            parse_mode=ParseMode.HTML,
+            reply_markup=cart_keyboard()
+        )
+        return
+    
+    order = place_order(user, profile.phone, profile.address, flow_id)
+    await query.edit_message_text(order_confirmation_text(order), parse_mode=ParseMode.HTML)
+    await notify_admins(context, admin_order_text(order))
+
+def place_order(user, phone: str, address: str, flow_id: str) -> Order:
+    """Turn the user's reserved cart into an order and remember their details"""
+    inventory.commit(user.id)
+    cart = carts.pop(user.id, {})
+    items = [
+        OrderItem(
+            product_id=pid,
+            product_name=products[pid].name,
+            quantity=qty,
+            unit_price=products[pid].price
+        )
+        for pid, qty in cart.items() if pid in products
+    ]
+    
+    order_id = generate_order_id()
+    order = Order(
+        order_id=order_id,
+        user_id=user.id,
+        username=user.username,
+        full_name=user.full_name,
+        phone=phone,
+        items=items,
+        total_price=sum(item.unit_price * item.quantity for item in items),
+        delivery_address=address,
+        status="pending",
+        timestamp=get_timestamp()
+    )
+    
+    orders[order_id] = order
+    remember(completed_flows, f"{user.id}:{flow_id}", order_id)
+    customer_profiles[user.id] = CustomerProfile(user_id=user.id, phone=phone, address=address)
+    user_states.pop(user.id, None)
+    save_data()
+    return order
+
+def order_confirmation_text(order: Order) -> str:
+    return (
+        f"✅ <b>Order Confirmed!</b>\n\n"
+        f"📋 Order ID: `{order.order_id}`\n"
+        f"🛍️ Items:\n{format_order_items(order)}"
+        f"💰 Total: {format_price(order.total_price)}\n"
+        f"📱 Phone: {html.escape(order.phone)}\n"
+        f"🏠 Delivery Address: {html.escape(order.delivery_address)}\n\n"
+        f"⏳ Status: Pending confirmation\n\n"
+        f"We'll contact you shortly! 🙏"
+    )
+
+def admin_order_text(order: Order) -> str:
+    return (
+        f"🚨 <b>NEW ORDER</b>\n\n"
+        f"📋 Order ID: `{order.order_id}`\n"
+        f"👤 Customer: {html.escape(order.full_name)}"
+        f"{f' (@{order.username})' if order.username else ''}\n"
+        f"📱 Phone: {html.escape(order.phone)}\n"
+        f"🛍️ Items:\n{format_order_items(order)}"
+        f"💰 Total: {format_price(order.total_price)}\n"
+        f"🏠 Delivery Address: {html.escape(order.delivery_address)}\n"
+        f"🕐 Time: {order.timestamp}\n\n"
+    )
+
 async def handle_order_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle user input during order process"""
+    """Handle quantity input and add the item to the cart"""
     user_id = update.effective_user.id
     text = update.message.text.strip()
     
@@ -371,29 +1369,42 @@ async def handle_order_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     state = user_states[user_id]
-    step = state.get("step")
     
-    if step == "quantity":
+    if state.get("step") == "quantity":
         try:
             quantity = int(text)
             if quantity <= 0:
                 raise ValueError
-            state["quantity"] = quantity
-            state["step"] = "phone"
-            
-            product = products[state["product_id"]]
-            total = product.price * quantity
-            
-            await update.message.reply_text(
-                f"📦 Quantity: {quantity}\n"
-                f"💰 Total: {format_price(total)}\n\n"
-                f"📱 Please enter your phone number:",
-                parse_mode=ParseMode.HTML
-            )
         except ValueError:
             await update.message.reply_text("❌ Please enter a valid number (e.g., 1, 2, 3)")
+            return
+        
+        cart = carts.setdefault(user_id, {})
+        available = inventory.available_for(user_id, state["product_id"])
+        if cart.get(state["product_id"], 0) + quantity > available:
+            await update.message.reply_text(f"❌ Only {max(0, available)} left. Please enter a smaller number.")
+            return
+        cart[state["product_id"]] = cart.get(state["product_id"], 0) + quantity
+        user_states.pop(user_id, None)
+        
+        await update.message.reply_text(
+            f"✅ Added to cart!\n\n{cart_text(cart)}",
+            parse_mode=ParseMode.HTML,
+            reply_markup=cart_keyboard()
+        )
+
+async def handle_checkout_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle phone and address input during checkout"""
+    user_id = update.effective_user.id
+    text = update.message.text.strip()
+    
+    if user_id not in user_states or user_states[user_id].get("action") != "checkout":
+        return
     
-    elif step == "phone":
+    state = user_states[user_id]
+    step = state.get("step")
+    
+    if step == "phone":
         if not (text.startswith('+') and len(text) >= 10 and text[1:].isdigit()):
             await update.message.reply_text("❌ Please enter a valid phone number (e.g., +2349040164120)")
             return
@@ -405,64 +1416,24 @@ async def handle_order_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
     
     elif step == "address":
-        state["address"] = text
-        
-        # Create order
-        product = products[state["product_id"]]
-        quantity = state["quantity"]
-        total = product.price * quantity
-        
-        order_id = generate_order_id()
-        order = Order(
-            order_id=order_id,
-            user_id=user_id,
-            username=update.effective_user.username,
-            full_name=update.effective_user.full_name,
-            phone=state["phone"],
-            product_id=state["product_id"],
-            product_name=product.name,
-            quantity=quantity,
-            total_price=total,
-            delivery_address=state["address"],
-            status="pending",
-            timestamp=get_timestamp()
-        )
-        
-        orders[order_id] = order
-        save_data()
-        
-        # Confirmation to user
-        await update.message.reply_text(
-            f"✅ <b>Order Confirmed!</b>\n\n"
-            f"📋 Order ID: `{order_id}`\n"
-            f"🛍️ Product: {product.name}\n"
-            f"📦 Quantity: {quantity}\n"
-            f"💰 Total: {format_price(total)}\n"
-            f"📱 Phone: {state['phone']}\n"
-            f"🏠 Delivery Address: {state['address']}\n\n"
-            f"⏳ Status: Pending confirmation\n\n"
-            f"We'll contact you shortly! 🙏",
-            parse_mode=ParseMode.HTML
-        )
-        
-        admin_message = (
-            f"🚨 <b>NEW ORDER</b>\n\n"
-            f"📋 Order ID: `{order_id}`\n"
-            f"👤 Customer: {order.full_name}"
-            f"{f' (@{order.username})' if order.username else ''}\n"
-            f"📱 Phone: {order.phone}\n"
-            f"🛍️ Product: {product.name}\n"
-            f"📦 Quantity: {quantity}\n"
-            f"💰 Total: {format_price(total)}\n"
-            f"🏠 Delivery Address: {state['address']}\n"
-            f"🕐 Time: {order.timestamp}\n\n"
-            
-        )
+        if not carts.get(user_id):
+            user_states.pop(user_id, None)
+            await update.message.reply_text("🛒 Your cart is empty.")
+            return
         
-        await notify_admins(context, admin_message)
+        short = ensure_reservation(user_id)
+        if short:
+            user_states.pop(user_id, None)
+            await update.message.reply_text(
+                f"{trim_cart_to_stock(user_id, short)}\n\n{cart_text(carts[user_id])}",
+                parse_mode=ParseMode.HTML,
+                reply_markup=cart_keyboard()
+            )
+            return
         
-        # Clear state
-        user_states.pop(user_id, None)
+        order = place_order(update.effective_user, state["phone"], text, state["flow_id"])
+        await update.message.reply_text(order_confirmation_text(order), parse_mode=ParseMode.HTML)
+        await notify_admins(context, admin_order_text(order))
 
 # ============= ORDER MANAGEMENT =============
 async def my_orders(query):
@@ -470,6 +1441,14 @@ async def my_orders(query):
     user_id = query.from_user.id
     user_orders = [o for o in orders.values() if o.user_id == user_id]
     
+    # Top up from the archive, newest first, only as far as the list shows
+    for order_id in reversed(archived_order_ids(user_id)):
+        if len(user_orders) >= 10:
+            break
+        order = get_archived_order(order_id)
+        if order:
+            user_orders.append(order)
+    
     if not user_orders:
         await query.edit_message_text(
             "📭 You haven't placed any orders yet.\n\nStart shopping!",
@@ -486,17 +1465,11 @@ async def my_orders(query):
     keyboard = []
     
     for order in user_orders[:10]:  # Show last 10 orders
-        status_emoji = {
-            "pending": "⏳",
-            "confirmed": "✅",
-            "shipped": "🚚",
-            "delivered": "📦",
-            "cancelled": "❌"
-        }.get(order.status, "⏳")
+        status_emoji = STATUS_EMOJI.get(order.status, "⏳")
         
         text += (
             f"{status_emoji} <b>{order.order_id}</b>\n"
-            f"   {order.product_name} x{order.quantity}\n"
+            f"   {', '.join(f'{item.product_name} x{item.quantity}' for item in order.items)}\n"
             f"   {format_price(order.total_price)} - {order.status.title()}\n\n"
         )
         
@@ -513,6 +1486,33 @@ async def my_orders(query):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+async def order_details(query, order_id: str):
+    """Show a single order, hot or archived"""
+    order = get_order(order_id)
+    
+    if not order or (order.user_id != query.from_user.id and not is_admin(query.from_user.id)):
+        await query.answer("Order not found!", show_alert=True)
+        return
+    
+    text = (
+        f"{STATUS_EMOJI.get(order.status, '⏳')} <b>Order {order.order_id}</b>\n\n"
+        f"🛍️ Items:\n{format_order_items(order)}"
+        f"💰 Total: {format_price(order.total_price)}\n"
+        f"📱 Phone: {html.escape(order.phone)}\n"
+        f"🏠 Delivery Address: {html.escape(order.delivery_address)}\n"
+        f"🕐 Placed: {order.timestamp}\n"
+        f"📌 Status: {order.status.title()}"
+    )
+    
+    await query.edit_message_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("◀️ Back", callback_data="my_orders")],
+            [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
+        ])
+    )
+
 # ============= ADMIN FUNCTIONS =============
 async def admin_panel(query):
     """Show admin panel"""
@@ -521,8 +1521,9 @@ async def admin_panel(query):
         return
     
     pending_orders = len([o for o in orders.values() if o.status == "pending"])
-    total_orders = len(orders)
+    total_orders = len(orders) + len(archive_index["orders"])
     total_products = len(products)
+    inventory.expire()
     
     text = (
         f"⚙️ <b>Admin Panel</b>\n\n"
@@ -530,12 +1531,14 @@ async def admin_panel(query):
         f"• Products: {total_products}\n"
         f"• Total Orders: {total_orders}\n"
         f"• Pending Orders: {pending_orders}\n"
+        f"• Low Stock: {len(inventory.low_stock)}\n"
     )
     
     keyboard = [
         [InlineKeyboardButton("➕ Add Product", callback_data="add_product")],
         [InlineKeyboardButton("📦 Manage Orders", callback_data="admin_orders")],
         [InlineKeyboardButton("🛍️ Manage Products", callback_data="manage_products")],
+        [InlineKeyboardButton("📬 Delivery Health", callback_data="delivery_health")],
         [InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]
     ]
     
@@ -557,9 +1560,8 @@ async def add_product_start(query):
     }
     
     keyboard = [
-        [InlineKeyboardButton("💻 Laptop(PCs)", callback_data="category_pc")],
-        [InlineKeyboardButton("Laptop Stickers", callback_data="category_laptop")],
-        [InlineKeyboardButton("👟 Shoes", callback_data="category_shoes")],
+        [InlineKeyboardButton(category.name, callback_data=f"category_{key}")]
+        for key, category in categories.items()
     ]
     
     await query.edit_message_text(
@@ -594,6 +1596,17 @@ async def handle_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if price <= 0:
                 raise ValueError
             state["price"] = price
+            state["step"] = "stock"
+            await update.message.reply_text("📦 How many are in stock? (numbers only, e.g., 10):")
+        except ValueError:
+            await update.message.reply_text("❌ Please enter a valid price (e.g., 50000)")
+    
+    elif step == "stock":
+        try:
+            stock = int(update.message.text.strip())
+            if stock < 0:
+                raise ValueError
+            state["stock"] = stock
             state["step"] = "images"
             state["images"] = []
             await update.message.reply_text(
@@ -601,7 +1614,7 @@ async def handle_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 "Type 'done' when finished"
             )
         except ValueError:
-            await update.message.reply_text("❌ Please enter a valid price (e.g., 50000)")
+            await update.message.reply_text("❌ Please enter a valid quantity (e.g., 10)")
     
     elif step == "images":
         if update.message.text and update.message.text.lower() == "done":
@@ -613,16 +1626,19 @@ async def handle_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 category=state["category"],
                 description=state["description"],
                 price=state["price"],
-                images=state["images"]
+                images=state["images"],
+                stock=state["stock"]
             )
             
             products[product_id] = product
+            inventory.reindex(product_id)
             save_data()
             
             await update.message.reply_text(
                 f"✅ <b>Product Added!</b>\n\n"
                 f"📦 {product.name}\n"
                 f"💰 {format_price(product.price)}\n"
+                f"📦 {product.stock} in stock\n"
                 f"📸 {len(product.images)} images\n\n"
                 f"<b>Product is now live!</b>",
                 parse_mode=ParseMode.HTML
@@ -678,6 +1694,37 @@ async def admin_orders(query):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+async def delivery_health_view(query):
+    """Show reachable vs unreachable users"""
+    if not is_admin(query.from_user.id):
+        return
+    
+    total_users = len(user_ids_set)
+    active = len(active_user_ids())
+    inactive = total_users - active
+    skipped = delivery_stats["skipped_sends"]
+    # Every skipped send frees one slot of the global rate limit
+    saved_seconds = skipped / GLOBAL_RATE_LIMIT
+    
+    text = (
+        f"📬 <b>Delivery Health</b>\n\n"
+        f"👥 Users: {total_users}\n"
+        f"✅ Active: {active}\n"
+        f"💤 Inactive: {inactive}\n\n"
+        f"⏭️ Sends skipped: {skipped}\n"
+        f"⏱️ Send time saved: ~{saved_seconds:.0f}s\n\n"
+        f"<i>Users go inactive after {DEAD_USER_FAILURE_THRESHOLD} failed sends in a row "
+        f"and come back when they /start again.</i>"
+    )
+    
+    await query.edit_message_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("◀️ Back", callback_data="admin_panel")
+        ]])
+    )
+
 # ============= CALLBACK HANDLER =============
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all button callbacks"""
@@ -702,12 +1749,40 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await view_product(query, product_id)
         return
     
+    # Order details (must come before the order_ prefix)
+    if data.startswith("order_details_"):
+        order_id = data.replace("order_details_", "")
+        await order_details(query, order_id)
+        return
+    
     # Start order
     if data.startswith("order_"):
         product_id = data.replace("order_", "")
         await start_order(query, product_id)
         return
     
+    # Cart and checkout
+    if data == "view_cart":
+        await show_cart(query)
+        return
+    
+    if data == "clear_cart":
+        await clear_cart(query)
+        return
+    
+    if data == "checkout":
+        await start_checkout(query)
+        return
+    
+    if data.startswith("checkout_saved_"):
+        flow_id = data.replace("checkout_saved_", "")
+        await checkout_saved_details(query, context, flow_id)
+        return
+    
+    if data == "checkout_new":
+        await checkout_new_details(query)
+        return
+    
     # My orders
     if data == "my_orders":
         await my_orders(query)
@@ -727,6 +1802,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("category_"):
         category = data.replace("category_", "")
         user_id = query.from_user.id
+        if category not in categories:
+            # Stale button from before a /reloadcategories
+            await query.edit_message_text("❌ That category no longer exists. Start again with Add Product.")
+            if user_states.get(user_id, {}).get("action") == "add_product":
+                user_states.pop(user_id, None)
+            return
         if user_id in user_states and user_states[user_id].get("action") == "add_product":
             user_states[user_id]["category"] = category
             user_states[user_id]["step"] = "name"
@@ -737,6 +1818,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin_orders":
         await admin_orders(query)
         return
+    
+    # Delivery health
+    if data == "delivery_health":
+        await delivery_health_view(query)
+        return
 
 # ============= MESSAGE HANDLER =============
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -750,6 +1836,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if action == "ordering":
             await handle_order_input(update, context)
             return
+        elif action == "checkout":
+            await handle_checkout_input(update, context)
+            return
         elif action == "add_product":
             await handle_add_product(update, context)
             return
@@ -770,60 +1859,194 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     message = " ".join(context.args)
     
-    # Use tracked user IDs instead of just order users
-    total_users = len(user_ids_set)
+    # Use tracked user IDs instead of just order users, skipping unreachable ones
+    recipients = active_user_ids()
+    total_users = len(recipients)
+    skipped = len(user_ids_set) - total_users
+    delivery_stats["skipped_sends"] += skipped
     sent = 0
     failed = 0
     
     await update.message.reply_text(f"📤 Broadcasting to {total_users} users...")
     
-    for user_id in user_ids_set:
+    # Queued as bulk traffic so customer replies keep flowing meanwhile
+    async def send(user_id: int):
+        nonlocal sent, failed
         try:
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"📢 <b>Announcement</b>\n\n{message}",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                rate_limit_args={"priority": PRIORITY_BULK}
             )
             sent += 1
         except Exception as e:
             failed += 1
             logger.error(f"Failed to send to {user_id}: {e}")
     
+    await asyncio.gather(*(send(user_id) for user_id in recipients))
+    save_data()
+    
     await update.message.reply_text(
         f"✅ **Broadcast Complete!**\n\n"
         f"✅ Sent: {sent}\n"
         f"❌ Failed: {failed}\n"
+        f"⏭️ Skipped (inactive): {skipped}\n"
         f"📊 Total: {total_users}"
     )
 
+async def reload_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Re-read the categories file without restarting"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    if not load_categories():
+        await update.message.reply_text(f"❌ Could not load {CATEGORIES_FILE}, keeping the current categories")
+        return
+    
+    text = f"✅ Reloaded {len(categories)} categories:\n\n"
+    for key, category in categories.items():
+        text += f"• {key}: {category.name} ({inventory.category_count(key)} in stock)\n"
+    await update.message.reply_text(text)
+
+async def set_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set a product's stock level"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    try:
+        product_id, stock = context.args[0], int(context.args[1])
+        if stock < 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "Usage: /setstock <product_id> <quantity>\n\n"
+            "Example: /setstock PRD0001 25"
+        )
+        return
+    
+    if product_id not in products:
+        await update.message.reply_text("❌ Product not found")
+        return
+    
+    # Held units are promised to open checkouts; going below them would oversell on commit
+    inventory.expire()
+    held = inventory.reserved.get(product_id, 0)
+    if stock < held:
+        await update.message.reply_text(
+            f"❌ {held} units are held by open checkouts. "
+            f"Set at least {held}, or try again once those checkouts finish."
+        )
+        return
+    
+    product = products[product_id]
+    product.stock = stock
+    inventory.reindex(product_id)
+    save_data()
+    
+    await update.message.reply_text(
+        f"✅ {product.name}: {product.stock} in stock "
+        f"({inventory.available(product_id)} available after reservations)"
+    )
+
+async def slow_traces_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the most recent slow-update traces"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    if not slow_traces:
+        status = "on" if TRACE_SAMPLE_RATE > 0 else "off"
+        await update.message.reply_text(f"🐢 No slow updates captured (tracing is {status}).")
+        return
+    
+    def render(span: Dict, depth: int) -> str:
+        line = f"{'  ' * depth}{span['name']} {span['duration_ms']}ms\n"
+        return line + "".join(render(child, depth + 1) for child in span["children"])
+    
+    text = ""
+    for record in list(slow_traces)[-5:]:
+        text += f"🐢 {record['time']} ({record['duration_ms']}ms)\n{render(record['trace'], 0)}\n"
+    
+    await update.message.reply_text(text[-4000:])
+
 # ============= ERROR HANDLER =============
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors"""
-    logger.error(f"Error: {context.error}")
+    logger.error(f"Error: {context.error}", exc_info=context.error)
+
+# ============= BACKGROUND TASKS =============
+# Plain asyncio tasks: the job-queue extra isn't installed, and tasks made with
+# Application.create_task would be awaited (forever) on shutdown.
+background_tasks: List[asyncio.Task] = []
+
+async def run_periodically(interval: float, func):
+    """Call func every interval seconds until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            func()
+        except Exception as e:
+            logger.error(f"Error in background task {func.__name__}: {e}")
+
+async def post_init(application: Application):
+    """Start background maintenance once the bot is up"""
+    background_tasks.append(asyncio.create_task(run_periodically(RESERVATION_SWEEP_INTERVAL, inventory.expire)))
+    background_tasks.append(asyncio.create_task(run_periodically(ARCHIVE_INTERVAL, archive_old_orders)))
+
+async def post_shutdown(application: Application):
+    """Stop background maintenance"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
 
 # ============= MAIN =============
 def main():
     """Start the bot"""
     load_data()
+    load_categories()
+    load_archive_index()
+    
+    if TRACE_SAMPLE_RATE > 0:
+        slow_trace_logger.addHandler(RotatingFileHandler(SLOW_TRACE_FILE, maxBytes=1_000_000, backupCount=3, encoding="utf-8"))
+        slow_trace_logger.setLevel(logging.INFO)
+    archive_old_orders()
     
     if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         print("❌ Please set your BOT_TOKEN in the code")
         return
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(OUTBOUND_CONCURRENCY + SPARE_CONNECTIONS)
+        .rate_limiter(OutboundScheduler())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Drop updates we've already handled before anything else sees them
+    app.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
     
-    # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("cancel", cancel))
-    app.add_handler(CommandHandler("broadcast", broadcast))
+    # Commands (every handler goes through wrap_handler for tracing and idempotency)
+    app.add_handler(CommandHandler("start", wrap_handler(start)))
+    app.add_handler(CommandHandler("help", wrap_handler(help_command)))
+    app.add_handler(CommandHandler("cancel", wrap_handler(cancel)))
+    app.add_handler(CommandHandler("broadcast", wrap_handler(broadcast), block=False))
+    app.add_handler(CommandHandler("setstock", wrap_handler(set_stock)))
+    app.add_handler(CommandHandler("slowtraces", wrap_handler(slow_traces_command)))
+    app.add_handler(CommandHandler("reloadcategories", wrap_handler(reload_categories)))
     
     # Callbacks
-    app.add_handler(CallbackQueryHandler(button_callback))
+    app.add_handler(CallbackQueryHandler(wrap_handler(button_callback)))
     
     # Messages
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_add_product))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, wrap_handler(handle_message)))
+    app.add_handler(MessageHandler(filters.PHOTO, wrap_handler(handle_add_product)))
     
     # Error handler
     app.add_error_handler(error_handler)